@@ -9,6 +9,11 @@
   :copyright: (c) 2012 by gregorynicholas.
   :license: MIT, see LICENSE for more details.
 """
+import re
+import sys
+import logging
+from collections import deque
+from hashlib import sha1
 from io import BytesIO
 from flask.testsuite import FlaskTestCase
 from google.appengine.ext import ndb
@@ -16,12 +21,25 @@ from google.appengine.ext import testbed
 from random import choice
 
 __all__ = ['TestCase', 'open_test_file', 'create_test_file', 'random_ndb_entity',
-'random_word', 'random_email', 'pprint_ndb_entity']
+'random_word', 'random_email', 'pprint_ndb_entity', 'ndb_entity_hash',
+'diff_ndb_entity', 'iter_ndb_entity_diffs', 'iter_pprint_ndb_kind',
+'dump_ndb_kind', 'LogCapture']
 
 class TestCase(FlaskTestCase):
   '''Enable app engine sdk stubs and disable services. This will replace calls
   to the service with calls to the service stub.'''
 
+  #: maximum number of application log records kept per test.
+  log_capture_size = 1000
+  #: minimum level of application log records captured per test.
+  #: defaults to the root logger's default level, so that everything the
+  #: root logger lets through is captured.
+  log_capture_level = logging.WARNING
+  #: lower the root logger to ``log_capture_level`` during tests. Set this
+  #: along with a lower ``log_capture_level``, otherwise records below the
+  #: root logger's level never reach the capture.
+  log_capture_lower_root = False
+
   def setUp(self):
     '''Base setUp intitializes the appengine sdk service stubs.'''
     FlaskTestCase.setUp(self)
@@ -60,6 +78,18 @@ class TestCase(FlaskTestCase):
     except testbed.StubNotSupportedError:
       pass
 
+    # capture application logs..
+    self.log_capture = LogCapture(
+      capacity=self.log_capture_size, level=self.log_capture_level)
+    if self.log_capture_size > 0:
+      root = logging.getLogger()
+      if self.log_capture_lower_root and \
+        root.getEffectiveLevel() > self.log_capture_level:
+        self.addCleanup(root.setLevel, root.level)
+        root.setLevel(self.log_capture_level)
+      self.addCleanup(root.removeHandler, self.log_capture)
+      root.addHandler(self.log_capture)
+
   def tearDown(self):
     '''Deactivate the testbed once the tests are completed. Otherwise the
     original stubs will not be restored.'''
@@ -86,6 +116,56 @@ class TestCase(FlaskTestCase):
       0, len(messages),
       "No matching email messages were sent.")
 
+  # logservice api helpers..
+  # ---------------------------------------------------------------------------
+
+  @property
+  def logservice_stub(self):
+    return self.testbed.get_stub(testbed.LOGSERVICE_SERVICE_NAME)
+
+  def get_logs(self, level=None, logger=None, pattern=None):
+    '''Returns a list of `logging.LogRecord` objects the application logged
+    during the test, with the specified criteria.
+
+      :param level:
+          exact level records must have. If ``level`` is ``None``, all levels
+          will be matched.
+      :param logger:
+          name of the logger records must come from. If ``logger`` is
+          ``None``, all loggers will be matched.
+      :param pattern:
+          regular expression searched for in the message. If ``pattern`` is
+          ``None``, all messages will be matched.'''
+    return self.log_capture.records(level=level, logger=logger, pattern=pattern)
+
+  def assertLogged(self, level, pattern=None, logger=None):
+    '''Asserts that the application logged at least one message at ``level``
+    matching ``pattern``.
+
+      :usage::
+
+        logging.warn('cache miss for %s', key)
+        self.assertLogged(logging.WARNING, r'^cache miss')
+    '''
+    if level < self.log_capture.level:
+      self.fail(
+        "%s messages are not captured, set log_capture_level to capture "
+        "them." % logging.getLevelName(level))
+    records = self.get_logs(level=level, logger=logger, pattern=pattern)
+    self.assertNotEqual(
+      0, len(records),
+      "No matching %s messages were logged." % logging.getLevelName(level))
+
+  def assertNoErrorsLogged(self):
+    '''Asserts that the application logged no messages at ``ERROR`` level or
+    above.'''
+    records = self.log_capture.records_at_least(logging.ERROR)
+    if records:
+      self.fail('%d error messages were logged:\n%s' % (
+        len(records), '\n'.join(
+          '%s:%s: %s' % (r.levelname, r.name, r.getMessage())
+          for r in records)))
+
   # memcache api helpers..
   # ---------------------------------------------------------------------------
 
@@ -180,6 +260,62 @@ class TestCase(FlaskTestCase):
     '''
     return random_ndb_entity(model_class, **kw)
 
+  # datastore api helpers..
+  # ---------------------------------------------------------------------------
+
+  def assertEntitiesEqual(self, expected, actual, max_diffs=10, msg=None):
+    '''Asserts that two iterables of `ndb.Model` entities hold the same
+    entities, matched up by key. Entities are compared by content hash, and a
+    field-level diff is only computed for the ones that don't match.
+
+      :param expected: iterable of expected entities.
+      :param actual: iterable of actual entities.
+      :param max_diffs:
+          maximum number of diff lines included in the failure message. Once
+          it is reached, the remaining differences and mismatched entities are
+          only counted. If ``None``, all of them are included.
+      :param msg: optional message prepended to the diff report.'''
+    report = []
+    omitted = 0
+    for mismatch in _iter_ndb_mismatches(expected, actual):
+      if max_diffs is not None and len(report) >= max_diffs:
+        # only count the rest, without diffing or formatting them..
+        omitted += 1
+        continue
+      report.extend(_format_ndb_mismatch(*mismatch))
+    trimmed = 0
+    if max_diffs is not None and len(report) > max_diffs:
+      trimmed = len(report) - max_diffs
+      del report[max_diffs:]
+    if not report and not omitted:
+      return
+    if trimmed:
+      report.append('... and %d more differences.' % trimmed)
+    if omitted:
+      report.append('... and %d more mismatched entities.' % omitted)
+    if msg:
+      report.insert(0, msg)
+    self.fail('\n'.join(report))
+
+  def assertDatastoreMatches(self, model_class, expected, batch_size=100,
+    max_diffs=10, msg=None):
+    '''Asserts that the entities of ``model_class`` kind stored in the
+    datastore are exactly the ``expected`` entities. The stored entities are
+    streamed in batches rather than loaded all at once.
+
+      :usage::
+
+        self.assertDatastoreMatches(User, [User(id='a', name='a')])
+
+      :param model_class: `ndb.Model` subclass to query.
+      :param expected: iterable of expected entities.
+      :param batch_size: number of entities fetched per datastore batch.
+      :param max_diffs:
+          maximum number of diff lines included in the failure message.
+      :param msg: optional message prepended to the diff report.'''
+    actual = model_class.query().iter(batch_size=batch_size)
+    self.assertEntitiesEqual(expected, actual, max_diffs=max_diffs, msg=msg)
+
 
 # mock a file upload request..
 # see README for usage.
@@ -216,6 +352,75 @@ def create_test_file(data='testing', filename='test_file.jpg'):
   return (BytesIO(data), filename, len(data))
 
 
+# capture application logs..
+# see TestCase.get_logs for usage.
+
+class LogCapture(logging.Handler):
+  '''Logging handler that keeps the most recent ``capacity`` records in a ring
+  buffer, indexed by logger name and level. Records below ``level`` are
+  rejected by the logging module before they reach the handler, and messages
+  are only rendered when they are looked up.'''
+
+  def __init__(self, capacity=1000, level=logging.NOTSET):
+    logging.Handler.__init__(self, level)
+    self.capacity = capacity
+    self.clear()
+
+  def clear(self):
+    '''Discards all captured records.'''
+    self.dropped = 0
+    self.buffer = deque()
+    self.by_logger = {}
+    self.by_level = {}
+
+  def emit(self, record):
+    if self.capacity <= 0:
+      return
+    if len(self.buffer) >= self.capacity:
+      # the evicted record is the oldest one, so it is also the oldest in its
+      # logger and level indexes..
+      oldest = self.buffer.popleft()
+      self.by_logger[oldest.name].popleft()
+      self.by_level[oldest.levelno].popleft()
+      self.dropped += 1
+    self.buffer.append(record)
+    self.by_logger.setdefault(record.name, deque()).append(record)
+    self.by_level.setdefault(record.levelno, deque()).append(record)
+
+  def records(self, level=None, logger=None, pattern=None):
+    '''Returns a list of captured `logging.LogRecord` objects, oldest first,
+    with the specified criteria.
+
+      :param level:
+          exact level records must have. If ``level`` is ``None``, all levels
+          will be matched.
+      :param logger:
+          name of the logger records must come from. If ``logger`` is
+          ``None``, all loggers will be matched.
+      :param pattern:
+          regular expression searched for in the rendered message. If
+          ``pattern`` is ``None``, all messages will be matched.'''
+    if level is not None and logger is not None:
+      records = self.by_level.get(level, ())
+      if len(self.by_logger.get(logger, ())) < len(records):
+        records = self.by_logger.get(logger, ())
+      records = [r for r in records if r.levelno == level and r.name == logger]
+    elif level is not None:
+      records = self.by_level.get(level, ())
+    elif logger is not None:
+      records = self.by_logger.get(logger, ())
+    else:
+      records = self.buffer
+    if pattern is not None:
+      search = re.compile(pattern).search
+      return [r for r in records if search(r.getMessage())]
+    return list(records)
+
+  def records_at_least(self, level):
+    '''Returns a list of captured records at ``level`` or above, oldest
+    first.'''
+    return [r for r in self.buffer if r.levelno >= level]
+
 
 _seed = """Lorem ipsum dolor sit amet consectetur adipiscing elit Nullam sit \
 amet sapien auctor erat pretium molestie Pellentesque interdum consequat dolor \
@@ -286,17 +491,166 @@ def random_ndb_entity(cls, **values):
     entity.populate(**values)
     return entity
 
+def _iter_ndb_values(entity):
+  '''Yields ``(name, value)`` pairs for the properties of an `ndb.Model`,
+  sorted by name, without building an intermediate dict like `to_dict`. As
+  with `to_dict`, properties are named by attribute and unprojected properties
+  are skipped.'''
+  props = sorted(entity._properties.itervalues(), key=lambda p: p._code_name)
+  for prop in props:
+    try:
+      yield prop._code_name, prop._get_for_dict(entity)
+    except ndb.UnprojectedPropertyError:
+      pass
+
+def _canonical_ndb_value(value):
+  '''Returns a form of a property value whose repr is the same for values
+  that compare equal, e.g. ``'a'`` and ``u'a'``, or ``1`` and ``1L``. Dicts
+  and tuples are tagged so they don't collide with other containers.'''
+  if isinstance(value, str):
+    try:
+      return value.decode('utf-8')
+    except UnicodeDecodeError:
+      return value
+  if isinstance(value, (int, long)) and not isinstance(value, bool):
+    return long(value)
+  if isinstance(value, dict):
+    return ('dict', tuple(sorted(
+      (_canonical_ndb_value(k), _canonical_ndb_value(v))
+      for k, v in value.iteritems())))
+  if isinstance(value, tuple):
+    return ('tuple', [_canonical_ndb_value(v) for v in value])
+  if isinstance(value, list):
+    return [_canonical_ndb_value(v) for v in value]
+  return value
+
 def pprint_ndb_entity(model, level=1):
   '''Pretty prints an `ndb.Model`.
 
     :returns:
   '''
   body = ['<', type(model).__name__, ':']
-  # for field in sorted(doc._fields, key=lambda f: f.number):
-  values = model.to_dict()
-  for key, value in values.iteritems():
+  for key, value in _iter_ndb_values(model):
     if value is not None:
       body.append('\n%s%s: %s' % (
         ' '.join([' ' for idx in range(level)]), key, repr(value)))
   body.append('>')
   return ''.join(body)
+
+def ndb_entity_hash(entity):
+  '''
+    :param entity: instance of an `ndb.Model`.
+    :returns:
+      String digest of the entity's kind and property values. Entities with
+      equal digests have equal content.
+  '''
+  digest = sha1(entity._get_kind())
+  for name, value in _iter_ndb_values(entity):
+    digest.update('\0%s=%s' % (name, repr(_canonical_ndb_value(value))))
+  return digest.hexdigest()
+
+def diff_ndb_entity(expected, actual):
+  '''Compares two `ndb.Model` entities field by field.
+
+    :returns:
+      List of ``(name, expected_value, actual_value)`` tuples for every
+      property that differs. ``name`` is ``'__kind__'`` if the entities are
+      of different kinds.
+  '''
+  if expected._get_kind() != actual._get_kind():
+    return [('__kind__', expected._get_kind(), actual._get_kind())]
+  expected_values = dict(_iter_ndb_values(expected))
+  actual_values = dict(_iter_ndb_values(actual))
+  diffs = []
+  for name in sorted(set(expected_values) | set(actual_values)):
+    expected_value = expected_values.get(name)
+    actual_value = actual_values.get(name)
+    if expected_value != actual_value:
+      diffs.append((name, expected_value, actual_value))
+  return diffs
+
+def _iter_ndb_mismatches(expected, actual):
+  '''Compares two iterables of `ndb.Model` entities, matched up by key, and
+  yields a ``(status, key, expected_entity, actual_entity)`` tuple for each
+  mismatched entity, without computing field-level diffs. ``status`` is one
+  of ``'+'`` (unexpected), ``'-'`` (missing), ``'~'`` (changed) or ``'!'``
+  (duplicate).'''
+  pending = {}
+  for entity in expected:
+    if entity.key is None:
+      raise ValueError('Expected entity has no key: %r' % entity)
+    if entity.key in pending:
+      raise ValueError('Duplicate expected entity key: %r' % entity.key)
+    pending[entity.key] = (ndb_entity_hash(entity), entity)
+  seen = set()
+  for entity in actual:
+    if entity.key is None:
+      raise ValueError('Actual entity has no key: %r' % entity)
+    if entity.key in seen:
+      yield '!', entity.key, None, entity
+      continue
+    seen.add(entity.key)
+    match = pending.pop(entity.key, None)
+    if match is None:
+      yield '+', entity.key, None, entity
+      continue
+    digest, expected_entity = match
+    if digest != ndb_entity_hash(entity):
+      yield '~', entity.key, expected_entity, entity
+  for key in sorted(pending, key=lambda k: k.flat()):
+    yield '-', key, pending[key][1], None
+
+def _format_ndb_mismatch(status, key, expected_entity, actual_entity):
+  '''Returns the report lines for a mismatch from `_iter_ndb_mismatches`.'''
+  if status == '+':
+    return ['+ %r: unexpected entity' % key]
+  if status == '-':
+    return ['- %r: missing entity' % key]
+  if status == '!':
+    return ['! %r: duplicate entity' % key]
+  return ['~ %r.%s: %r != %r' % (key, name, expected_value, actual_value)
+          for name, expected_value, actual_value
+          in diff_ndb_entity(expected_entity, actual_entity)]
+
+def iter_ndb_entity_diffs(expected, actual):
+  '''Compares two iterables of `ndb.Model` entities, matched up by key, and
+  yields a compact line of report for each difference. Only a content hash is
+  kept for the ``actual`` entities, so ``actual`` can be a streamed query.
+
+    :param expected: iterable of expected entities.
+    :param actual: iterable of actual entities.
+    :raises ValueError:
+      if an entity doesn't have a key, or two expected entities have the same
+      key.
+  '''
+  for mismatch in _iter_ndb_mismatches(expected, actual):
+    for line in _format_ndb_mismatch(*mismatch):
+      yield line
+
+def iter_pprint_ndb_kind(model_class, batch_size=100, level=1):
+  '''Yields a `pprint_ndb_entity` string for each stored entity of
+  ``model_class`` kind, fetching them from the datastore in batches.
+
+    :param model_class: `ndb.Model` subclass to query.
+    :param batch_size: number of entities fetched per datastore batch.
+  '''
+  for entity in model_class.query().iter(batch_size=batch_size):
+    yield pprint_ndb_entity(entity, level=level)
+
+def dump_ndb_kind(model_class, stream=None, batch_size=100):
+  '''Writes every stored entity of ``model_class`` kind to ``stream``, one at
+  a time, without materializing the whole kind.
+
+    :param model_class: `ndb.Model` subclass to query.
+    :param stream: file-like object to write to. Defaults to `sys.stdout`.
+    :param batch_size: number of entities fetched per datastore batch.
+    :returns: number of entities written.
+  '''
+  if stream is None:
+    stream = sys.stdout
+  count = 0
+  for text in iter_pprint_ndb_kind(model_class, batch_size=batch_size):
+    stream.write(text)
+    stream.write('\n')
+    count += 1
+  return count